@@ -11,11 +11,11 @@ import io
 from typing import Any, Dict, List, Optional, Union
 import docker
 from docker.errors import DockerException, ImageNotFound, NotFound
+from docker.utils.socket import STDERR, frames_iter
 from mcp.server.sse import SseServerTransport
 from starlette.applications import Starlette
 from starlette.requests import Request
 from starlette.routing import Mount, Route
-from mcp.server import Server
 import uvicorn
 import argparse
 import tarfile
@@ -23,6 +23,15 @@ import io as BytesIO
 import logging
 import json
 import threading
+import hashlib
+import atexit
+import shlex
+import socket
+import functools
+import itertools
+import posixpath
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -41,10 +50,76 @@ docker_available = False
 # 默认的Docker镜像
 DEFAULT_IMAGE = "python:3.9-slim"
 
-# 常驻容器的名称和ID
-PERSISTENT_CONTAINER_NAME = "code_sandbox_persistent"
-persistent_container_id = None
-container_lock = threading.Lock()  # 用于控制容器访问的锁
+# 镜像仓库代理地址（例如 "registry.example.com/dockerhub"），设置后从代理拉取Docker Hub镜像
+REGISTRY_MIRROR = os.getenv("REGISTRY_MIRROR")
+
+# 已确认存在于本地的镜像，之后不再向Docker查询
+local_images = set()
+
+# 沙箱镜像的构建目录（包含Dockerfile和requirements.txt）
+SANDBOX_BUILD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox")
+SANDBOX_IMAGE_REPO = "code-sandbox"
+sandbox_image = None  # 已构建的沙箱镜像标签
+
+# 容器池配置
+POOL_SIZE = int(os.getenv("SANDBOX_POOL_SIZE", "4"))  # 池中常驻容器的数量，每个工作区按ID固定分配到其中一个
+POOL_LABEL = "code-sandbox-pool"  # 用于识别池中容器的标签
+# 标签的值记录创建容器的服务实例（主机名:进程号），同一Docker主机上的多个实例互不清理对方的容器
+POOL_INSTANCE = f"{socket.gethostname()}:{os.getpid()}"
+
+# 流式上传tarball时每次读取的数据块大小
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+# 进入各工作目录的shell命令缓存：工作目录 -> 转义后的cd命令
+cd_commands = {}
+
+# 每条命令的stdout和stderr各自最多保留的字节数，超出部分被截断
+MAX_OUTPUT_BYTES = int(os.getenv("SANDBOX_MAX_OUTPUT_BYTES", str(1024 * 1024)))
+
+# 小于该大小的文件通过exec的stdin直接写入，不再打包为tarball
+SMALL_FILE_THRESHOLD = 64 * 1024
+
+# 复制项目目录时跳过的文件和目录名（本地的字节码缓存对容器中的解释器无用）
+COPY_PROJECT_SKIP_NAMES = frozenset({"__pycache__"})
+
+# 按需加载的项目：项目ID -> 登记信息（容器、本地目录、文件索引和已加载的文件）
+registered_projects = {}
+PROJECT_INDEX_NAME = ".sandbox_index.json"  # 上传到容器中的项目索引文件名
+LAZY_FETCH_EAGER_RATIO = 0.8  # 一次加载的数据量超过未加载部分的该比例时，改为整体复制项目
+
+POOL_USE_GPU = os.getenv("SANDBOX_USE_GPU", "").lower() in ("1", "true", "yes")  # 池中的容器是否使用GPU
+
+# 可分配给容器的GPU编号（例如 "0,1"），未设置时每个容器申请任意一块GPU
+GPU_DEVICE_IDS = [i.strip() for i in os.getenv("SANDBOX_GPU_IDS", "").split(",") if i.strip()]
+gpu_slot_counter = itertools.count()  # 轮流分配GPU编号
+
+container_slots = []  # 池中的常驻容器，下标为槽位编号，None表示容器已失效、等待重新创建
+slot_locks = []  # 每个槽位一个锁，避免同一槽位重复创建容器
+slots_init_lock = threading.Lock()  # 保护槽位列表的初始化
+pooled_containers = {}  # 由容器池管理的所有容器，容器ID -> Container
+container_workspaces = {}  # 容器ID -> 容器中的工作区ID集合
+workspaces_lock = threading.Lock()  # 保护工作区的分配和回收
+dedicated_containers = set()  # 为单个工作区创建、用完即删除的容器ID
+container_exec_locks = {}  # (容器ID, 工作区ID) -> asyncio.Lock，同一工作区中的命令依次执行（只在事件循环中增删）
+exec_locks_loop = None  # 执行锁所属的事件循环，其他线程通过它清理执行锁
+pool_refill_event = threading.Event()  # 通知后台线程补充容器池
+pool_shutdown_event = threading.Event()  # 通知后台线程退出
+
+# 容器对象缓存：容器ID -> (Container, 过期时间)
+CONTAINER_CACHE_TTL = 30  # 秒
+CONTAINER_CACHE_SIZE = 128
+container_cache = {}
+
+# Docker不可用时所有工具返回的结果（预先构造，调用方不得修改）
+# 注意：FastMCP只能序列化普通dict，不能使用MappingProxyType
+DOCKER_UNAVAILABLE = {
+    "success": False,
+    "error": "Docker服务不可用"
+}
+
+# 执行阻塞的Docker调用所用的线程池，避免阻塞事件循环
+DOCKER_MAX_WORKERS = int(os.getenv("SANDBOX_DOCKER_WORKERS", "32"))
+docker_executor = ThreadPoolExecutor(max_workers=DOCKER_MAX_WORKERS, thread_name_prefix="docker")
 
 # 检查Docker是否可用
 try:
@@ -56,74 +131,375 @@ except Exception as e:
     logger.error(f"Docker服务不可用: {e}")
     logger.error("无法使用Docker容器沙箱功能")
 
-def ensure_persistent_container():
-    """确保持久化容器正在运行"""
-    global persistent_container_id
-    
-    with container_lock:
-        if persistent_container_id is not None:
-            # 检查容器是否仍在运行
-            try:
-                container = docker_client.containers.get(persistent_container_id)
-                if container.status == "running":
-                    return persistent_container_id
-            except NotFound:
-                persistent_container_id = None
-                logger.warning("持久化容器已被删除，将重新创建")
-        
-        # 尝试查找已有的容器
+async def run_blocking(func, *args, **kwargs):
+    """在线程池中执行阻塞的函数（如docker-py调用），并等待其结果"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(docker_executor, functools.partial(func, *args, **kwargs))
+
+async def lookup_container(container_id):
+    """
+    获取容器对象，避免每次调用都向Docker守护进程查询。
+    池容器直接使用登记的对象，其他容器按CONTAINER_CACHE_TTL缓存。
+    """
+    container = pooled_containers.get(container_id)
+    if container is not None:
+        return container
+    
+    now = time.monotonic()
+    cached = container_cache.get(container_id)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    
+    container = await run_blocking(docker_client.containers.get, container_id)
+    if len(container_cache) >= CONTAINER_CACHE_SIZE:
+        # 淘汰最早缓存的容器
+        container_cache.pop(next(iter(container_cache)), None)
+    container_cache[container_id] = (container, now + CONTAINER_CACHE_TTL)
+    return container
+
+def invalidate_container(container_id):
+    """从缓存中移除容器对象（容器被删除时调用）"""
+    container_cache.pop(container_id, None)
+
+def resolve_image(image):
+    """如果配置了镜像仓库代理，将Docker Hub上的镜像名改写为代理地址"""
+    if not REGISTRY_MIRROR:
+        return image
+    
+    # 镜像名中已经包含仓库地址时不做改写
+    registry = image.split("/", 1)[0]
+    if "/" in image and ("." in registry or ":" in registry or registry == "localhost"):
+        return image
+    return f"{REGISTRY_MIRROR.rstrip('/')}/{image}"
+
+def ensure_image(image):
+    """确保镜像在本地存在，只有本地不存在时才从仓库拉取，返回实际使用的镜像名"""
+    image = resolve_image(image)
+    if image in local_images:
+        return image
+    
+    try:
+        docker_client.images.get(image)
+    except ImageNotFound:
+        logger.info(f"拉取Docker镜像: {image}")
+        docker_client.images.pull(image)
+    local_images.add(image)
+    return image
+
+def ensure_sandbox_image():
+    """确保预装依赖的沙箱镜像存在，按构建文件的内容哈希缓存"""
+    global sandbox_image
+    
+    if sandbox_image is not None:
+        return sandbox_image
+    
+    # 根据基础镜像以及Dockerfile和requirements.txt的内容计算镜像标签
+    base_image = resolve_image(DEFAULT_IMAGE)
+    digest = hashlib.sha256(base_image.encode('utf-8'))
+    for name in ("Dockerfile", "requirements.txt"):
+        with open(os.path.join(SANDBOX_BUILD_DIR, name), "rb") as f:
+            digest.update(f.read())
+    tag = f"{SANDBOX_IMAGE_REPO}:{digest.hexdigest()[:12]}"
+    
+    try:
+        docker_client.images.get(tag)
+        logger.info(f"使用已构建的沙箱镜像: {tag}")
+    except ImageNotFound:
+        # 基础镜像已在本地时不再访问镜像仓库
+        ensure_image(DEFAULT_IMAGE)
+        logger.info(f"构建沙箱镜像: {tag}")
+        docker_client.images.build(
+            path=SANDBOX_BUILD_DIR,
+            tag=tag,
+            rm=True,
+            pull=False,
+            buildargs={"BASE_IMAGE": base_image}
+        )
+    
+    sandbox_image = tag
+    return sandbox_image
+
+def gpu_options(use_gpu, slot=None):
+    """
+    生成创建容器时的GPU参数。
+    每个容器只申请一块GPU；配置了SANDBOX_GPU_IDS时按槽位（或依次轮流）分配，使池中的容器分摊不同的GPU。
+    """
+    if not use_gpu:
+        return {}
+    
+    if GPU_DEVICE_IDS:
+        index = slot if slot is not None else next(gpu_slot_counter)
+        device_request = docker.types.DeviceRequest(
+            device_ids=[GPU_DEVICE_IDS[index % len(GPU_DEVICE_IDS)]],
+            capabilities=[['gpu']]
+        )
+    else:
+        device_request = docker.types.DeviceRequest(count=1, capabilities=[['gpu']])
+    return {
+        "runtime": "nvidia",  # 使用NVIDIA运行时
+        "device_requests": [device_request]
+    }
+
+def spawn_pool_container(use_gpu=None, slot=None):
+    """创建一个新的常驻容器并登记到容器池"""
+    if use_gpu is None:
+        use_gpu = POOL_USE_GPU
+    image = ensure_sandbox_image()
+    
+    container = docker_client.containers.run(
+        image=image,
+        entrypoint=["tail", "-f", "/dev/null"],  # 保持容器常驻
+        labels={POOL_LABEL: POOL_INSTANCE},
+        working_dir="/app",
+        detach=True,
+        remove=False,  # 不自动删除
+        ports={},  # 不映射端口
+        network_mode="none",  # 禁用网络
+        cap_drop=["ALL"],  # 移除所有权限
+        security_opt=["no-new-privileges"],  # 安全选项
+        mem_limit="256m",  # 内存限制
+        cpu_quota=100000,  # CPU限制
+        cpu_period=100000,  # CPU周期
+        **gpu_options(use_gpu, slot)
+    )
+    
+    pooled_containers[container.id] = container
+    logger.info(f"创建常驻容器成功, ID: {container.id}")
+    return container
+
+def init_container_slots():
+    """按POOL_SIZE创建槽位列表（只执行一次）"""
+    with slots_init_lock:
+        if not container_slots:
+            container_slots.extend([None] * max(POOL_SIZE, 1))
+            slot_locks.extend(threading.Lock() for _ in container_slots)
+
+def route_workspace(workspace_id):
+    """工作区固定路由到的槽位：工作区ID的哈希值对池大小取模"""
+    return zlib.crc32(workspace_id.encode('utf-8')) % len(container_slots)
+
+def pool_container_alive(container):
+    """
+    检查池容器是否仍可使用，已停止或暂停的容器尝试恢复运行。
+    返回True表示容器可用，False表示容器已被删除或无法再启动；
+    Docker调用出错等无法确定的情况返回None，此时保留容器，下一轮再检查。
+    """
+    try:
+        container.reload()
+        if container.status == "running":
+            return True
+        
+        logger.warning(f"池容器 {container.id} 状态为 {container.status}，尝试恢复运行")
         try:
-            existing = docker_client.containers.get(PERSISTENT_CONTAINER_NAME)
-            if existing.status != "running":
-                existing.start()
-            persistent_container_id = existing.id
-            logger.info(f"使用已存在的持久化容器，ID: {persistent_container_id}")
-            return persistent_container_id
+            if container.status == "paused":
+                container.unpause()
+            else:
+                container.start()
         except NotFound:
-            pass  # 容器不存在，继续创建新容器
+            raise
+        except DockerException as e:
+            logger.warning(f"恢复池容器 {container.id} 失败: {e}")
         
-        # 创建新的持久化容器
+        # 重新查询状态，确认容器是否已恢复
+        container.reload()
+        if container.status == "running":
+            return True
+        if container.status == "dead":
+            logger.warning(f"池容器 {container.id} 已无法启动，将重新创建")
+            return False
+        return None
+    except NotFound:
+        logger.warning(f"池容器 {container.id} 已被删除，将重新创建")
+        return False
+    except DockerException as e:
+        logger.warning(f"检查池容器 {container.id} 状态失败，下一轮重试: {e}")
+        return None
+
+def drop_pool_container(container):
+    """从池中摘除失效的容器，其槽位随后重新创建容器"""
+    with workspaces_lock:
+        container_workspaces.pop(container.id, None)
+        pooled_containers.pop(container.id, None)
+        for slot, slot_container in enumerate(container_slots):
+            if slot_container is not None and slot_container.id == container.id:
+                container_slots[slot] = None
+    forget_projects(container.id)
+    forget_exec_locks_threadsafe(container.id)
+    invalidate_container(container.id)
+    try:
+        container.remove(force=True)
+    except DockerException:
+        pass  # 容器可能已不存在
+
+def ensure_slot_container(slot):
+    """返回槽位中正在运行的容器，槽位为空或容器已失效时创建新容器"""
+    with slot_locks[slot]:
+        container = container_slots[slot]
+        # 只有确认容器已失效时才替换；状态无法确定时保留容器，避免误删其中的工作区
+        if container is not None and pool_container_alive(container) is False:
+            drop_pool_container(container)
+            container = None
+        if container is None:
+            container = spawn_pool_container(slot=slot)
+            container_slots[slot] = container
+        return container
+
+def fill_container_pool():
+    """为所有空的槽位创建容器"""
+    init_container_slots()
+    for slot in range(len(container_slots)):
+        if pool_shutdown_event.is_set():
+            break
+        ensure_slot_container(slot)
+
+def pool_refill_worker():
+    """后台线程：定期检查池中的容器，为空出的槽位或已失效的容器重新创建容器"""
+    while not pool_shutdown_event.is_set():
+        pool_refill_event.wait(timeout=30)
+        pool_refill_event.clear()
         try:
-            logger.info(f"拉取Docker镜像: {DEFAULT_IMAGE}")
-            docker_client.images.pull(DEFAULT_IMAGE)
-            
-            # 创建容器配置
-            container = docker_client.containers.run(
-                image=DEFAULT_IMAGE,
-                name=PERSISTENT_CONTAINER_NAME,
-                working_dir="/app",
-                detach=True,
-                tty=True,
-                stdin_open=True,
-                remove=False,  # 不自动删除
-                ports={},  # 不映射端口
-                network_mode="none",  # 禁用网络
-                cap_drop=["ALL"],  # 移除所有权限
-                security_opt=["no-new-privileges"],  # 安全选项
-                mem_limit="256m",  # 内存限制
-                cpu_quota=100000,  # CPU限制
-                cpu_period=100000,  # CPU周期
-                runtime="nvidia",  # 使用NVIDIA运行时
-                device_requests=[
-                    docker.types.DeviceRequest(
-                        count=-1,  # 使用所有可用GPU
-                        capabilities=[['gpu']]
-                    )
-                ]
-            )
-            
-            persistent_container_id = container.id
-            logger.info(f"创建持久化容器成功, ID: {persistent_container_id}")
-            
-            # 初始化容器
-            container.exec_run(["mkdir", "-p", "/app/workspaces"])
-            
-            return persistent_container_id
+            fill_container_pool()
         except Exception as e:
-            logger.error(f"创建持久化容器失败: {e}")
-            raise
+            logger.error(f"补充容器池失败: {e}")
+
+def assign_workspace(workspace_id, use_gpu=False):
+    """为新工作区选择容器：按工作区ID固定路由到池中的一个容器，同一容器可承载多个工作区"""
+    if use_gpu and not POOL_USE_GPU:
+        # 容器池中的容器没有GPU，为该工作区单独创建一个GPU容器，用完后删除
+        logger.info("容器池未启用GPU，为工作区单独创建GPU容器")
+        container = spawn_pool_container(use_gpu=True)
+        with workspaces_lock:
+            dedicated_containers.add(container.id)
+            container_workspaces[container.id] = {workspace_id}
+        return container
+    
+    init_container_slots()
+    slot = route_workspace(workspace_id)
+    while True:
+        container = ensure_slot_container(slot)
+        with workspaces_lock:
+            # 容器可能在此期间因失效被替换，此时重新获取槽位中的容器
+            if container_slots[slot] is container:
+                container_workspaces.setdefault(container.id, set()).add(workspace_id)
+                return container
+
+def forget_projects(container_id, workspace_path=None):
+    """移除容器（或容器中某个工作区）内按需加载项目的登记信息"""
+    for project_id, project in list(registered_projects.items()):
+        if project["container_id"] != container_id:
+            continue
+        if workspace_path is None or project["target_dir"].startswith(f"{workspace_path}/") or project["target_dir"] == workspace_path:
+            registered_projects.pop(project_id, None)
+
+def remove_workspace(container, workspace_id):
+    """
+    删除容器中的工作区。池容器保留在槽位中继续承载其他工作区，只有失效时才会被替换；
+    工作区专用的GPU容器随工作区一起删除。容器被删除时返回True
+    """
+    workspace_path = f"/app/workspaces/{workspace_id}"
+    forget_projects(container.id, workspace_path)
+    cd_commands.pop(workspace_path, None)
+    
+    with workspaces_lock:
+        workspaces = container_workspaces.get(container.id)
+        if workspaces is not None:
+            workspaces.discard(workspace_id)
+        dedicated = container.id in dedicated_containers
+        if dedicated:
+            dedicated_containers.discard(container.id)
+            container_workspaces.pop(container.id, None)
+            pooled_containers.pop(container.id, None)
+    
+    if dedicated:
+        logger.info(f"删除工作区专用的GPU容器 {container.id}")
+        container.remove(force=True)
+        return True
+    
+    # 删除工作区目录，容器留给之后路由到该槽位的工作区使用
+    container.exec_run(["rm", "-rf", workspace_path])
+    return False
+
+def exec_lock(container_id, workspace_id=None):
+    """
+    工作区的执行锁：同一工作区中的命令依次执行。
+    同一池容器承载多个工作区，不同工作区之间互不阻塞。
+    """
+    global exec_locks_loop
+    exec_locks_loop = asyncio.get_running_loop()
+    key = (container_id, workspace_id)
+    lock = container_exec_locks.get(key)
+    if lock is None:
+        lock = container_exec_locks[key] = asyncio.Lock()
+    return lock
+
+def forget_exec_locks(container_id):
+    """移除容器中所有工作区的执行锁（容器被删除时调用），只能在事件循环中调用"""
+    for key in [key for key in list(container_exec_locks) if key[0] == container_id]:
+        container_exec_locks.pop(key, None)
+
+def forget_exec_locks_threadsafe(container_id):
+    """在后台线程中移除容器的执行锁：交给执行锁所属的事件循环完成"""
+    loop = exec_locks_loop
+    if loop is None:
+        return  # 还没有创建过执行锁
+    try:
+        loop.call_soon_threadsafe(forget_exec_locks, container_id)
+    except RuntimeError:
+        pass  # 事件循环已关闭
+
+def pool_owner_gone(owner):
+    """
+    池容器标签中记录的服务实例是否已退出。
+    只能判断本机上的进程，其他主机（或其他容器中）的实例一律视为仍在运行。
+    """
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    if int(pid) == os.getpid():
+        return True  # 本进程启动前不会有自己的容器，说明是之前使用相同进程号的实例遗留的
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass  # 进程存在，但属于其他用户
+    return False
+
+def start_container_pool():
+    """启动时清理遗留的池容器，创建池中的常驻容器并启动补充线程"""
+    if not docker_available:
+        return
+    
+    try:
+        logger.info("启动时初始化容器池...")
+        stale = docker_client.containers.list(all=True, filters={"label": POOL_LABEL})
+        for container in stale:
+            # 仍在运行、且所属实例可能还在运行的容器属于其他服务实例，不能删除
+            if container.status == "running" and not pool_owner_gone(container.labels.get(POOL_LABEL, "")):
+                continue
+            container.remove(force=True)
+        
+        fill_container_pool()
+        threading.Thread(target=pool_refill_worker, name="pool-refill", daemon=True).start()
+        logger.info(f"容器池已准备就绪，常驻容器数量: {len(container_slots)}")
+    except Exception as e:
+        logger.error(f"初始化容器池失败: {e}")
+
+@atexit.register
+def shutdown_container_pool():
+    """进程退出时移除所有由容器池管理的容器"""
+    pool_shutdown_event.set()
+    pool_refill_event.set()
+    for container_id, container in list(pooled_containers.items()):
+        try:
+            container.remove(force=True)
+            logger.info(f"已移除池容器 {container_id}")
+        except Exception as e:
+            logger.warning(f"移除池容器 {container_id} 失败: {e}")
+    pooled_containers.clear()
+
 @mcp.tool()
-async def sandbox_initialize(image: str = DEFAULT_IMAGE, use_persistent: bool = True) -> Dict[str, Any]:
+async def sandbox_initialize(image: str = DEFAULT_IMAGE, use_persistent: bool = True, use_gpu: bool = False) -> Dict[str, Any]:
     """
     初始化一个新的代码执行计算环境。
     基于指定的Docker镜像创建一个容器，默认使用Python slim镜像。
@@ -131,60 +507,41 @@ async def sandbox_initialize(image: str = DEFAULT_IMAGE, use_persistent: bool =
     参数:
     image: 作为基础环境的Docker镜像 (例如 'python:3.9-slim')
     use_persistent: 是否使用持久化容器（如果为True，image参数将被忽略）
+    use_gpu: 是否为容器分配一块NVIDIA GPU（需要安装NVIDIA Container Toolkit）
     
     返回:
     包含容器ID和工作区ID的字典，可用于与该环境交互
     """
     if not docker_available:
-        return {
-            "success": False,
-            "error": "Docker服务不可用"
-        }
+        return DOCKER_UNAVAILABLE
     
     try:
         if use_persistent:
-            # 检查持久化容器是否已存在
-            try:
-                existing = docker_client.containers.get(PERSISTENT_CONTAINER_NAME)
-                container_id = existing.id
-                workspace_id = str(uuid.uuid4())
-                workspace_path = f"/app/workspaces/{workspace_id}"
-                
-                # 在容器中创建工作区目录
-                existing.exec_run(["mkdir", "-p", workspace_path])
-                
-                return {
-                    "success": True,
-                    "container_id": container_id,
-                    "workspace_id": workspace_id,
-                    "workspace_path": workspace_path,
-                    "mode": "persistent",
-                    "message": "使用已存在的持久化容器"
-                }
-            except NotFound:
-                # 持久化容器不存在，创建新容器
-                container_id = ensure_persistent_container()
-                workspace_id = str(uuid.uuid4())
-                workspace_path = f"/app/workspaces/{workspace_id}"
-                
-                # 在容器中创建工作区目录
-                container = docker_client.containers.get(container_id)
-                container.exec_run(["mkdir", "-p", workspace_path])
-                
-                return {
-                    "success": True,
-                    "container_id": container_id,
-                    "workspace_id": workspace_id,
-                    "workspace_path": workspace_path,
-                    "mode": "persistent"
-                }
+            # 按工作区ID分配到容器池中的一个容器
+            workspace_id = str(uuid.uuid4())
+            workspace_path = f"/app/workspaces/{workspace_id}"
+            container = await run_blocking(assign_workspace, workspace_id, use_gpu)
+            
+            # 通过put_archive在容器中创建工作区目录，无需单独执行mkdir
+            await run_blocking(
+                put_archive_streaming, container, "/app/workspaces",
+                lambda tar: add_dir_entries(tar, workspace_id, archive_mtime())
+            )
+            
+            return {
+                "success": True,
+                "container_id": container.id,
+                "workspace_id": workspace_id,
+                "workspace_path": workspace_path,
+                "mode": "persistent"
+            }
         else:
             # 使用传统的独立容器模式
-            logger.info(f"拉取Docker镜像: {image}")
-            docker_client.images.pull(image)
+            image = await run_blocking(ensure_image, image)
             
             # 创建容器配置
-            container = docker_client.containers.run(
+            container = await run_blocking(
+                docker_client.containers.run,
                 image=image,
                 working_dir="/app",
                 detach=True,
@@ -198,6 +555,7 @@ async def sandbox_initialize(image: str = DEFAULT_IMAGE, use_persistent: bool =
                 mem_limit="256m",  # 内存限制
                 cpu_quota=100000,  # CPU限制
                 cpu_period=100000,  # CPU周期
+                **gpu_options(use_gpu)
             )
             
             container_id = container.id
@@ -214,8 +572,146 @@ async def sandbox_initialize(image: str = DEFAULT_IMAGE, use_persistent: bool =
             "success": False,
             "error": f"创建容器失败: {str(e)}"
         }
+def cd_command(working_dir):
+    """进入工作目录的shell命令，目录经过shlex.quote转义，按目录缓存"""
+    command = cd_commands.get(working_dir)
+    if command is None:
+        command = cd_commands[working_dir] = f"cd {shlex.quote(working_dir)}"
+    return command
+
+def build_batch_script(working_dir, commands, markers):
+    """把多条命令合并为一个shell脚本，每条命令前输出标记，遇到失败的命令立即退出"""
+    lines = [f"{cd_command(working_dir)} || exit $?"]
+    for cmd, marker in zip(commands, markers):
+        # 标记同时写入stdout和stderr，便于分别切分两路输出
+        lines.append(f"echo {marker}; echo {marker} >&2")
+        # 每条命令在独立的sh中执行，与逐条调用exec_run时的语义保持一致
+        lines.append(f"sh -c {shlex.quote(cmd)}")
+        lines.append("rc=$?; [ $rc -eq 0 ] || exit $rc")
+    return "\n".join(lines)
+
+class OutputCollector:
+    """
+    增量收集exec的一路输出（stdout或stderr）。
+    按标记把输出切分为每条命令的输出，每条命令最多保留limit字节，超出部分丢弃。
+    """
+    
+    def __init__(self, markers=(), limit=MAX_OUTPUT_BYTES):
+        self.markers = list(markers)
+        self.limit = limit
+        # 第一个标记之前的输出；没有出现任何标记时归入第一条命令
+        self.segments = [bytearray()]
+        self.sizes = [0]
+        self._next = 0  # 下一个要查找的标记
+        self._pending = b""  # 可能是标记前半部分的数据，留到下一块再判断
+    
+    def feed(self, data):
+        buf = self._pending + data if self._pending else data
+        self._pending = b""
+        while self._next < len(self.markers):
+            marker = self.markers[self._next]
+            pos = buf.find(marker)
+            if pos == -1:
+                keep = min(len(buf), len(marker) - 1)
+                self._append(buf[:len(buf) - keep])
+                self._pending = buf[len(buf) - keep:]
+                return
+            self._append(buf[:pos])
+            buf = buf[pos + len(marker):]
+            if self._next == 0:
+                # 丢弃第一个标记之前的输出
+                self.segments = [bytearray()]
+                self.sizes = [0]
+            else:
+                self.segments.append(bytearray())
+                self.sizes.append(0)
+            self._next += 1
+        self._append(buf)
+    
+    def finish(self):
+        """处理剩余的数据"""
+        if self._pending:
+            self._append(self._pending)
+            self._pending = b""
+    
+    @property
+    def marker_count(self):
+        """已经出现的标记数量"""
+        return self._next
+    
+    def _append(self, chunk):
+        if not chunk:
+            return
+        segment = self.segments[-1]
+        self.sizes[-1] += len(chunk)
+        room = self.limit - len(segment)
+        if room > 0:
+            segment += chunk[:room]
+    
+    def truncated(self, index):
+        return self.sizes[index] > len(self.segments[index])
+    
+    def text(self, index):
+        """返回第index段输出的文本，被截断时附加说明"""
+        if index >= len(self.segments):
+            return ""
+        text = self.segments[index].decode('utf-8', errors='replace')
+        if self.truncated(index):
+            text += f"\n...[输出过长已截断，共 {self.sizes[index]} 字节，仅保留前 {self.limit} 字节]"
+        return text
+
+def stream_exec(container, cmd, stdout, stderr):
+    """以流的方式执行exec，把输出逐块交给收集器，返回退出代码"""
+    exec_id = docker_client.api.exec_create(container.id, cmd, stdout=True, stderr=True)
+    for out, err in docker_client.api.exec_start(exec_id, stream=True, demux=True):
+        if out:
+            stdout.feed(out)
+        if err:
+            stderr.feed(err)
+    stdout.finish()
+    stderr.finish()
+    return docker_client.api.exec_inspect(exec_id)["ExitCode"]
+
+def command_result(cmd, exit_code, stdout, stderr, index=0):
+    """根据收集器中第index段输出构造单条命令的执行结果"""
+    return {
+        "command": cmd,
+        "exit_code": exit_code,
+        "stdout": stdout.text(index),
+        "stderr": stderr.text(index),
+        "success": exit_code == 0,
+        "truncated": stdout.truncated(index) or stderr.truncated(index)
+    }
+
+def exec_batch_commands(container, working_dir, commands):
+    """把所有命令合并为一个脚本，通过一次exec依次执行，遇到失败的命令即停止"""
+    markers = [f"__SANDBOX_MARK_{uuid.uuid4().hex}_{i}__" for i in range(len(commands))]
+    script = build_batch_script(working_dir, commands, markers)
+    
+    # 按标记切分出每条命令的输出
+    encoded_markers = [f"{marker}\n".encode('utf-8') for marker in markers]
+    stdout = OutputCollector(encoded_markers)
+    stderr = OutputCollector(encoded_markers)
+    exit_code = stream_exec(container, ["sh", "-c", script], stdout, stderr)
+    
+    # 没有输出任何标记说明脚本在第一条命令之前就失败了（例如无法进入工作目录）
+    executed = max(stdout.marker_count, 1) if commands else 0
+    results = []
+    for i in range(executed):
+        # 脚本在第一条失败的命令处退出，之前的命令都执行成功
+        cmd_exit_code = exit_code if i == executed - 1 else 0
+        results.append(command_result(commands[i], cmd_exit_code, stdout, stderr, i))
+    return results
+
+def exec_single_command(container, working_dir, cmd):
+    """在工作目录中通过单独的exec执行一条命令"""
+    stdout = OutputCollector()
+    stderr = OutputCollector()
+    exit_code = stream_exec(container, ["sh", "-c", f"{cd_command(working_dir)} && {cmd}"], stdout, stderr)
+    return command_result(cmd, exit_code, stdout, stderr)
+
 @mcp.tool()
-async def sandbox_exec(container_id: str, commands: List[str], workspace_id: str = None) -> Dict[str, Any]:
+async def sandbox_exec(container_id: str, commands: List[str], workspace_id: Optional[str] = None, parallel: bool = False) -> Dict[str, Any]:
     """
     在沙箱环境中执行命令。
     在指定的容器中运行一个或多个shell命令并返回输出。
@@ -224,98 +720,158 @@ async def sandbox_exec(container_id: str, commands: List[str], workspace_id: str
     container_id: 从initialize调用返回的容器ID
     commands: 要在沙箱环境中运行的命令列表
     workspace_id: 工作区ID（用于持久化容器模式）
+    parallel: 命令之间相互独立时设为True，所有命令会并发执行，某条命令失败不会影响其他命令
     
     返回:
     包含每个命令执行结果的字典
     """
     if not docker_available:
-        return {
-            "success": False,
-            "error": "Docker服务不可用"
-        }
+        return DOCKER_UNAVAILABLE
     
     try:
-        container = docker_client.containers.get(container_id)
-        results = []
+        container = await lookup_container(container_id)
         
         # 判断是否是持久化容器模式
         is_persistent = workspace_id is not None
         working_dir = f"/app/workspaces/{workspace_id}" if is_persistent else "/app"
         
-        # 首先检查并安装所需的Python包
-        try:
-            # 检查pip是否可用
-            _, pip_output = container.exec_run(
-                cmd=["which", "pip"],
-                stdout=True,
-                stderr=True
-            )
-            
-            if not pip_output:
-                # 如果pip不可用，先安装pip
-                logger.info(f"在容器 {container_id} 中安装pip")
-                container.exec_run(["apt-get", "update"])
-                container.exec_run(["apt-get", "install", "-y", "python3-pip"])
-        except Exception as e:
-            logger.warning(f"安装pip失败: {e}")
-            
-        # 执行每个命令
-        for cmd in commands:
-            cmd_to_run = cmd
-            if is_persistent:
-                # 在持久化模式下，确保命令在正确的工作目录中执行
-                cmd_to_run = f"cd {working_dir} && {cmd}"
-                
-            logger.info(f"在容器 {container_id} 中执行命令: {cmd_to_run}")
-            
-            # 如果命令是python脚本，先尝试安装所需的包
-            if cmd_to_run.startswith("python"):
-                try:
-                    # 执行pip install命令安装可能缺失的包
-                    container.exec_run(["pip", "install", "--upgrade", "pip"])
-                    container.exec_run(["pip", "install", "-r", "requirements.txt"])
-                except Exception as e:
-                    logger.warning(f"安装Python包失败: {e}")
-            
-            # 使用exec_run执行命令
-            exit_code, output = container.exec_run(
-                cmd=["sh", "-c", cmd_to_run],
-                stdout=True,
-                stderr=True,
-                demux=True,  # 将stdout和stderr分开
-            )
-            
-            # 处理输出
-            stdout, stderr = output
-            stdout = stdout.decode('utf-8') if stdout else ""
-            stderr = stderr.decode('utf-8') if stderr else ""
-            
-            results.append({
-                "command": cmd,
-                "exit_code": exit_code,
-                "stdout": stdout,
-                "stderr": stderr,
-                "success": exit_code == 0
-            })
-            
-            # 如果命令失败，停止执行后续命令
-            if exit_code != 0:
-                logger.warning(f"命令 '{cmd}' 执行失败，退出代码: {exit_code}")
-                break
-                
+        # 同一工作区中的调用依次执行，其他工作区（即使在同一容器中）不受影响
+        async with exec_lock(container.id, workspace_id):
+            if parallel and len(commands) > 1:
+                # 相互独立的命令在同一容器中并发执行，每条命令使用单独的exec
+                logger.info(f"在容器 {container_id} 中并发执行 {len(commands)} 条命令: {commands}")
+                results = await asyncio.gather(*[
+                    run_blocking(exec_single_command, container, working_dir, cmd) for cmd in commands
+                ])
+                results = list(results)
+            else:
+                logger.info(f"在容器 {container_id} 中执行 {len(commands)} 条命令: {commands}")
+                results = await run_blocking(exec_batch_commands, container, working_dir, commands)
+        
+        for result in results:
+            if not result["success"]:
+                logger.warning(f"命令 '{result['command']}' 执行失败，退出代码: {result['exit_code']}")
+        
         return {
             "success": True,
             "results": results
         }
     except Exception as e:
         logger.error(f"执行命令失败: {e}")
+        if container_id in pooled_containers:
+            # 池容器可能已停止或被删除，通知后台线程立即检查并替换
+            pool_refill_event.set()
         return {
             "success": False,
             "error": f"执行命令失败: {str(e)}"
         }
 
+def normalize_rel_dir(path):
+    """
+    规范化相对于工作目录的路径（去掉开头的斜杠和多余的部分），工作目录本身返回空字符串。
+    路径不能通过..指向工作目录之外，否则抛出ValueError。
+    """
+    if not path:
+        return ""
+    # 确保路径不是绝对路径（安全措施）
+    rel_path = posixpath.normpath(path.lstrip('/'))
+    if rel_path == ".." or rel_path.startswith("../"):
+        raise ValueError(f"路径不能位于工作目录之外: {path}")
+    return "" if rel_path == "." else rel_path
+
+def normalize_rel_file(path):
+    """规范化相对于工作目录的文件路径，规则同normalize_rel_dir，路径不能为空"""
+    rel_path = normalize_rel_dir(path)
+    if not rel_path:
+        raise ValueError(f"文件路径无效: {path!r}")
+    return rel_path
+
+def archive_path(rel_dir, name):
+    """tarball中位于相对目录下的成员名称"""
+    return f"{rel_dir}/{name}" if rel_dir else name
+
+def archive_mtime():
+    """
+    tarball中所有成员共用的修改时间，每个tarball只取一次。
+    不使用固定的时间戳：Python按源文件的修改时间和大小判断.pyc是否过期，
+    固定时间会让重写后大小不变的脚本继续使用旧的字节码。
+    """
+    return int(time.time())
+
+def add_dir_entries(tar, rel_dir, mtime):
+    """为相对目录的每一级添加目录条目，put_archive解压时会创建这些目录，无需单独执行mkdir"""
+    path = ""
+    for part in rel_dir.split("/") if rel_dir else []:
+        path = f"{path}/{part}" if path else part
+        dirinfo = tarfile.TarInfo(name=path)
+        dirinfo.type = tarfile.DIRTYPE
+        dirinfo.mode = 0o755
+        dirinfo.mtime = mtime
+        tar.addfile(dirinfo)
+
+def put_archive_streaming(container, path, add_members):
+    """
+    将tarball流式上传到容器的指定目录。
+    在后台线程中以流模式写入tar，同时通过管道把数据上传给Docker，
+    打包与上传并行进行，内存中只保留一个数据块。
+    
+    参数:
+    container: 目标容器
+    path: 容器中解压tarball的目录
+    add_members: 接收tarfile对象并向其中添加成员的函数
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+    
+    def write_tar():
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe_out:
+                with tarfile.open(fileobj=pipe_out, mode='w|') as tar:
+                    add_members(tar)
+        except Exception as e:
+            errors.append(e)
+    
+    writer = threading.Thread(target=write_tar, name="tar-writer", daemon=True)
+    writer.start()
+    try:
+        with os.fdopen(read_fd, 'rb') as pipe_in:
+            chunks = iter(lambda: pipe_in.read(ARCHIVE_CHUNK_SIZE), b"")
+            container.put_archive(path, chunks)
+    finally:
+        # 读端关闭后写入线程会因管道断开而退出
+        writer.join()
+    
+    if errors:
+        raise errors[0]
+
+def write_file_via_exec(container, file_path, file_data):
+    """
+    通过exec的stdin把数据写入容器中的文件。
+    创建目录和写入文件在同一条命令中完成，适用于小文件。
+    """
+    # 文件名可能包含子目录（如src/utils.py），需要创建文件所在的目录
+    cmd = f"mkdir -p {shlex.quote(posixpath.dirname(file_path))} && cat > {shlex.quote(file_path)}"
+    exec_id = docker_client.api.exec_create(container.id, ["sh", "-c", cmd], stdin=True)
+    sock = docker_client.api.exec_start(exec_id, socket=True)
+    raw_sock = getattr(sock, "_sock", sock)
+    stderr = []
+    try:
+        raw_sock.sendall(file_data)
+        raw_sock.shutdown(socket.SHUT_WR)  # 关闭写端，cat读到EOF后退出
+        # 读取到EOF，等待命令执行结束，同时收集错误输出
+        for stream, data in frames_iter(raw_sock, tty=False):
+            if stream == STDERR:
+                stderr.append(data)
+    finally:
+        sock.close()
+    
+    exit_code = docker_client.api.exec_inspect(exec_id)["ExitCode"]
+    if exit_code != 0:
+        error = b"".join(stderr).decode('utf-8', errors='replace').strip()
+        raise RuntimeError(f"写入文件命令失败，退出代码: {exit_code}, 错误: {error}")
+
 @mcp.tool()
-async def write_file_sandbox(container_id: str, file_name: str, file_contents: str, workspace_id: str = None, dest_dir: str = None) -> Dict[str, Any]:
+async def write_file_sandbox(container_id: str, file_name: str, file_contents: str, workspace_id: Optional[str] = None, dest_dir: Optional[str] = None) -> Dict[str, Any]:
     """
     将文件写入沙箱文件系统。
     在容器中创建具有指定内容的文件。
@@ -331,30 +887,19 @@ async def write_file_sandbox(container_id: str, file_name: str, file_contents: s
     写入操作的结果
     """
     if not docker_available:
-        return {
-            "success": False,
-            "error": "Docker服务不可用"
-        }
+        return DOCKER_UNAVAILABLE
     
     try:
-        container = docker_client.containers.get(container_id)
+        container = await lookup_container(container_id)
         
         # 判断是否是持久化容器模式
         is_persistent = workspace_id is not None
         base_dir = f"/app/workspaces/{workspace_id}" if is_persistent else "/app"
         
-        # 确定目标目录
-        if dest_dir is None:
-            target_dir = base_dir
-        else:
-            # 确保dest_dir不是绝对路径（安全措施）
-            if dest_dir.startswith('/'):
-                dest_dir = dest_dir.lstrip('/')
-            target_dir = os.path.join(base_dir, dest_dir)
-            
-        # 确保目标目录存在
-        mkdir_cmd = f"mkdir -p {target_dir}"
-        container.exec_run(["sh", "-c", mkdir_cmd])
+        # 确定目标目录（目录和文件名都不能指向工作目录之外）
+        rel_dir = normalize_rel_dir(dest_dir)
+        file_name = normalize_rel_file(file_name)
+        target_dir = f"{base_dir}/{rel_dir}" if rel_dir else base_dir
         
         # 计算完整文件路径
         if target_dir.endswith("/"):
@@ -363,25 +908,27 @@ async def write_file_sandbox(container_id: str, file_name: str, file_contents: s
         file_path = f"{target_dir}/{file_name}"
         logger.info(f"写入文件到容器 {container_id}: {file_path}")
         
-        # 创建包含文件内容的内存tarball
-        tar_stream = BytesIO.BytesIO()
-        tar = tarfile.open(fileobj=tar_stream, mode='w')
-        
-        # 添加文件到tarball
         file_data = file_contents.encode('utf-8')
-        file_obj = BytesIO.BytesIO(file_data)
         
-        tarinfo = tarfile.TarInfo(name=file_name)
-        tarinfo.size = len(file_data)
-        tarinfo.mtime = time.time()
-        tar.addfile(tarinfo, file_obj)
-        tar.close()
+        # 小文件直接通过exec的stdin写入，无需tar打包
+        if len(file_data) < SMALL_FILE_THRESHOLD:
+            await run_blocking(write_file_via_exec, container, file_path, file_data)
+            return {
+                "success": True,
+                "file_path": file_path
+            }
         
-        # 将tarball的内容重置到开始位置
-        tar_stream.seek(0)
+        def add_file(tar):
+            # 目标目录的条目在解压时自动创建，随后添加文件
+            mtime = archive_mtime()
+            add_dir_entries(tar, rel_dir, mtime)
+            tarinfo = tarfile.TarInfo(name=archive_path(rel_dir, file_name))
+            tarinfo.size = len(file_data)
+            tarinfo.mtime = mtime
+            tar.addfile(tarinfo, BytesIO.BytesIO(file_data))
         
-        # 将tarball复制到容器
-        container.put_archive(target_dir, tar_stream)
+        # 将tarball流式复制到容器
+        await run_blocking(put_archive_streaming, container, base_dir, add_file)
         
         return {
             "success": True,
@@ -395,7 +942,7 @@ async def write_file_sandbox(container_id: str, file_name: str, file_contents: s
         }
 
 @mcp.tool()
-async def copy_file(container_id: str, local_src_file: str, workspace_id: str = None, dest_path: str = None) -> Dict[str, Any]:
+async def copy_file(container_id: str, local_src_file: str, workspace_id: Optional[str] = None, dest_path: Optional[str] = None) -> Dict[str, Any]:
     """
     将单个文件复制到沙箱文件系统。
     将本地文件传输到指定的容器。
@@ -410,13 +957,10 @@ async def copy_file(container_id: str, local_src_file: str, workspace_id: str =
     复制操作的结果
     """
     if not docker_available:
-        return {
-            "success": False,
-            "error": "Docker服务不可用"
-        }
+        return DOCKER_UNAVAILABLE
     
     try:
-        container = docker_client.containers.get(container_id)
+        container = await lookup_container(container_id)
         
         # 检查源文件是否存在
         if not os.path.exists(local_src_file):
@@ -434,33 +978,21 @@ async def copy_file(container_id: str, local_src_file: str, workspace_id: str =
             dest_path = os.path.basename(local_src_file)
         
         # 确保dest_path不是绝对路径（安全措施）
-        if dest_path.startswith('/'):
-            dest_path = dest_path.lstrip('/')
+        dest_path = normalize_rel_file(dest_path)
+        rel_dir = posixpath.dirname(dest_path)
         
         # 构造完整目标路径
         full_dest_path = f"{base_dir}/{dest_path}"
         
-        # 确保目标目录存在
-        dest_dir = os.path.dirname(full_dest_path)
-        if dest_dir:
-            mkdir_cmd = f"mkdir -p {dest_dir}"
-            container.exec_run(["sh", "-c", mkdir_cmd])
-        
         logger.info(f"复制文件 {local_src_file} 到容器 {container_id}: {full_dest_path}")
         
-        # 创建包含文件的内存tarball
-        tar_stream = BytesIO.BytesIO()
-        tar = tarfile.open(fileobj=tar_stream, mode='w')
+        def add_file(tar):
+            # 目标目录的条目在解压时自动创建，随后添加文件
+            add_dir_entries(tar, rel_dir, archive_mtime())
+            tar.add(local_src_file, arcname=dest_path)
         
-        # 添加文件到tarball
-        tar.add(local_src_file, arcname=os.path.basename(full_dest_path))
-        tar.close()
-        
-        # 将tarball的内容重置到开始位置
-        tar_stream.seek(0)
-        
-        # 将tarball复制到容器
-        container.put_archive(os.path.dirname(full_dest_path) or '/', tar_stream)
+        # 将tarball流式复制到容器
+        await run_blocking(put_archive_streaming, container, base_dir, add_file)
         
         return {
             "success": True,
@@ -473,8 +1005,14 @@ async def copy_file(container_id: str, local_src_file: str, workspace_id: str =
             "error": f"复制文件失败: {str(e)}"
         }
 
+def skip_project_member(tarinfo):
+    """tar.add的过滤函数：跳过不需要复制到沙箱的成员"""
+    if os.path.basename(tarinfo.name) in COPY_PROJECT_SKIP_NAMES:
+        return None
+    return tarinfo
+
 @mcp.tool()
-async def copy_project(container_id: str, local_src_dir: str, workspace_id: str = None, dest_dir: str = None) -> Dict[str, Any]:
+async def copy_project(container_id: str, local_src_dir: str, workspace_id: Optional[str] = None, dest_dir: Optional[str] = None) -> Dict[str, Any]:
     """
     将目录复制到沙箱文件系统。
     将本地目录及其内容传输到指定的容器。
@@ -489,13 +1027,85 @@ async def copy_project(container_id: str, local_src_dir: str, workspace_id: str
     复制操作的结果
     """
     if not docker_available:
+        return DOCKER_UNAVAILABLE
+    
+    try:
+        container = await lookup_container(container_id)
+        
+        # 检查源目录是否存在
+        if not os.path.isdir(local_src_dir):
+            return {
+                "success": False,
+                "error": f"本地目录不存在: {local_src_dir}"
+            }
+        
+        # 判断是否是持久化容器模式
+        is_persistent = workspace_id is not None
+        base_dir = f"/app/workspaces/{workspace_id}" if is_persistent else "/app"
+        
+        # 确定目标目录
+        rel_dir = normalize_rel_dir(dest_dir)
+        target_dir = f"{base_dir}/{rel_dir}" if rel_dir else base_dir
+        
+        logger.info(f"复制目录 {local_src_dir} 到容器 {container_id}: {target_dir}")
+        
+        # 获取源目录的basename
+        src_dir_name = os.path.basename(os.path.normpath(local_src_dir))
+        
+        def add_project(tar):
+            # 目标目录的条目在解压时自动创建
+            add_dir_entries(tar, rel_dir, archive_mtime())
+            # 递归添加源目录的内容到tarball（目录遍历在写入线程中与上传并行进行）
+            tar.add(local_src_dir, arcname=archive_path(rel_dir, src_dir_name), recursive=True, filter=skip_project_member)
+        
+        # 将tarball流式复制到容器
+        await run_blocking(put_archive_streaming, container, base_dir, add_project)
+        
+        return {
+            "success": True,
+            "dest_dir": target_dir
+        }
+    except Exception as e:
+        logger.error(f"复制目录失败: {e}")
         return {
             "success": False,
-            "error": "Docker服务不可用"
+            "error": f"复制目录失败: {str(e)}"
         }
+
+def build_project_index(local_src_dir):
+    """为本地项目目录建立索引：相对路径 -> 文件大小"""
+    index = {}
+    for root, dirs, files in os.walk(local_src_dir):
+        dirs[:] = [d for d in dirs if d not in COPY_PROJECT_SKIP_NAMES]
+        for file in files:
+            if file in COPY_PROJECT_SKIP_NAMES:
+                continue
+            file_path = os.path.join(root, file)
+            rel_path = os.path.relpath(file_path, local_src_dir).replace(os.sep, "/")
+            index[rel_path] = os.path.getsize(file_path)
+    return index
+
+@mcp.tool()
+async def register_project(container_id: str, local_src_dir: str, workspace_id: Optional[str] = None, dest_dir: Optional[str] = None) -> Dict[str, Any]:
+    """
+    登记一个本地项目目录，按需把文件加载到沙箱中。
+    只上传项目的文件索引，文件内容在调用fetch_project_files时才复制到容器。
+    适用于较大且只会用到少量文件的项目；需要全部文件时请使用copy_project。
+    
+    参数:
+    container_id: 从initialize调用返回的容器ID
+    local_src_dir: 本地文件系统中目录的路径
+    workspace_id: 工作区ID（用于持久化容器模式）
+    dest_dir: 在沙盒环境中保存源目录的路径，相对于容器工作目录
+    
+    返回:
+    包含项目ID和容器中索引文件路径的字典
+    """
+    if not docker_available:
+        return DOCKER_UNAVAILABLE
     
     try:
-        container = docker_client.containers.get(container_id)
+        container = await lookup_container(container_id)
         
         # 检查源目录是否存在
         if not os.path.isdir(local_src_dir):
@@ -509,59 +1119,177 @@ async def copy_project(container_id: str, local_src_dir: str, workspace_id: str
         base_dir = f"/app/workspaces/{workspace_id}" if is_persistent else "/app"
         
         # 确定目标目录
-        if dest_dir is None:
-            target_dir = base_dir
-        else:
-            # 确保dest_dir不是绝对路径（安全措施）
-            if dest_dir.startswith('/'):
-                dest_dir = dest_dir.lstrip('/')
-            target_dir = os.path.join(base_dir, dest_dir)
+        rel_dir = normalize_rel_dir(dest_dir)
+        target_dir = f"{base_dir}/{rel_dir}" if rel_dir else base_dir
         
-        # 确保目标目录存在
-        mkdir_cmd = f"mkdir -p {target_dir}"
-        container.exec_run(["sh", "-c", mkdir_cmd])
+        src_dir_name = os.path.basename(os.path.normpath(local_src_dir))
+        index = await run_blocking(build_project_index, local_src_dir)
+        project_id = str(uuid.uuid4())
+        logger.info(f"登记项目 {local_src_dir} 到容器 {container_id}: {target_dir}，共 {len(index)} 个文件")
         
-        logger.info(f"复制目录 {local_src_dir} 到容器 {container_id}: {target_dir}")
+        index_data = json.dumps({"project_id": project_id, "files": index}, ensure_ascii=False).encode('utf-8')
         
-        # 创建包含目录内容的内存tarball
-        tar_stream = BytesIO.BytesIO()
-        tar = tarfile.open(fileobj=tar_stream, mode='w')
+        def add_index(tar):
+            # 目标目录、项目目录和索引文件
+            project_dir = archive_path(rel_dir, src_dir_name)
+            mtime = archive_mtime()
+            add_dir_entries(tar, project_dir, mtime)
+            
+            tarinfo = tarfile.TarInfo(name=f"{project_dir}/{PROJECT_INDEX_NAME}")
+            tarinfo.size = len(index_data)
+            tarinfo.mtime = mtime
+            tar.addfile(tarinfo, BytesIO.BytesIO(index_data))
         
-        # 获取源目录的basename
-        src_dir_name = os.path.basename(os.path.normpath(local_src_dir))
+        await run_blocking(put_archive_streaming, container, base_dir, add_index)
         
-        # 添加源目录的内容到tarball
-        for root, dirs, files in os.walk(local_src_dir):
-            # 计算当前目录与源目录的相对路径
-            arcroot = os.path.join(src_dir_name, os.path.relpath(root, local_src_dir))
-            
-            # 添加文件到tarball
-            for file in files:
-                file_path = os.path.join(root, file)
-                arc_path = os.path.join(arcroot, file) if arcroot != src_dir_name else os.path.join("", file)
-                tar.add(file_path, arcname=arc_path)
+        registered_projects[project_id] = {
+            "container_id": container.id,
+            "local_src_dir": local_src_dir,
+            "src_dir_name": src_dir_name,
+            "target_dir": target_dir,
+            "index": index,
+            "fetched": set()
+        }
         
-        tar.close()
+        return {
+            "success": True,
+            "project_id": project_id,
+            "dest_dir": f"{target_dir}/{src_dir_name}",
+            "index_path": f"{target_dir}/{src_dir_name}/{PROJECT_INDEX_NAME}",
+            "file_count": len(index),
+            "total_size": sum(index.values())
+        }
+    except Exception as e:
+        logger.error(f"登记项目失败: {e}")
+        return {
+            "success": False,
+            "error": f"登记项目失败: {str(e)}"
+        }
+
+@mcp.tool()
+async def fetch_project_files(project_id: str, paths: List[str]) -> Dict[str, Any]:
+    """
+    把已登记项目中的指定文件加载到沙箱中。
+    路径相对于项目根目录，指定目录时加载其下所有文件；已加载过的文件不会重复复制。
+    
+    参数:
+    project_id: 从register_project调用返回的项目ID
+    paths: 要加载的文件或目录路径列表
+    
+    返回:
+    加载操作的结果
+    """
+    if not docker_available:
+        return DOCKER_UNAVAILABLE
+    
+    project = registered_projects.get(project_id)
+    if project is None:
+        return {
+            "success": False,
+            "error": f"项目未登记: {project_id}"
+        }
+    
+    try:
+        container = await lookup_container(project["container_id"])
+        index = project["index"]
+        fetched = project["fetched"]
         
-        # 将tarball的内容重置到开始位置
-        tar_stream.seek(0)
+        # 根据索引解析要加载的文件
+        requested = set()
+        missing = []
+        for path in paths:
+            path = path.strip("/")
+            prefix = f"{path}/"
+            matched = [p for p in index if p == path or not path or p.startswith(prefix)]
+            if not matched:
+                missing.append(path)
+            requested.update(matched)
+        to_fetch = sorted(requested - fetched)
         
-        # 将tarball复制到容器
-        container.put_archive(target_dir, tar_stream)
+        local_src_dir = project["local_src_dir"]
+        src_dir_name = project["src_dir_name"]
+        
+        # 加载量超过一定比例时，直接整体复制项目比逐个文件打包更划算
+        total_size = sum(index.values())
+        pending_size = sum(index[p] for p in index if p not in fetched)
+        fetch_size = sum(index[p] for p in to_fetch)
+        eager = total_size > 0 and fetch_size > pending_size * LAZY_FETCH_EAGER_RATIO
+        
+        if to_fetch:
+            logger.info(f"加载项目 {project_id} 的 {len(to_fetch)} 个文件到容器 {container.id}" + ("（整体复制）" if eager else ""))
+            
+            def add_files(tar):
+                if eager:
+                    tar.add(local_src_dir, arcname=src_dir_name, recursive=True, filter=skip_project_member)
+                    return
+                for rel_path in to_fetch:
+                    tar.add(os.path.join(local_src_dir, rel_path), arcname=f"{src_dir_name}/{rel_path}")
+            
+            await run_blocking(put_archive_streaming, container, project["target_dir"], add_files)
+            fetched.update(index if eager else to_fetch)
         
         return {
             "success": True,
-            "dest_dir": target_dir
+            "fetched": to_fetch,
+            "missing": missing,
+            "fetched_count": len(fetched),
+            "file_count": len(index)
         }
     except Exception as e:
-        logger.error(f"复制目录失败: {e}")
+        logger.error(f"加载项目文件失败: {e}")
         return {
             "success": False,
-            "error": f"复制目录失败: {str(e)}"
+            "error": f"加载项目文件失败: {str(e)}"
         }
 
+class ChunkReader:
+    """把字节块的迭代器包装成只读的文件对象，供tarfile以流模式读取"""
+    
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = b""
+        self._offset = 0
+    
+    def read(self, size=-1):
+        parts = []
+        remaining = size
+        while size < 0 or remaining > 0:
+            if self._offset >= len(self._chunk):
+                try:
+                    self._chunk = next(self._chunks)
+                    self._offset = 0
+                except StopIteration:
+                    break
+                continue
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + remaining)
+            parts.append(self._chunk[self._offset:end])
+            remaining -= end - self._offset
+            self._offset = end
+        return b"".join(parts)
+
+def download_file_from_container(container, container_src_path, local_dest_path):
+    """从容器中获取文件的tarball，边接收边把其中的文件解压到本地路径"""
+    # 获取容器中的文件
+    bits, stat = container.get_archive(container_src_path, chunk_size=ARCHIVE_CHUNK_SIZE)
+    
+    # 创建包含目标目录的父目录（如果需要）
+    parent_dir = os.path.dirname(local_dest_path)
+    if parent_dir and not os.path.exists(parent_dir):
+        os.makedirs(parent_dir)
+    
+    # 以流模式解压tarball，内存中只保留一个数据块
+    with tarfile.open(fileobj=ChunkReader(bits), mode='r|') as tar:
+        # 获取第一个文件成员（应该只有一个）
+        member = tar.next()
+        if member is None or not member.isfile():
+            raise ValueError(f"不是普通文件: {container_src_path}")
+        
+        # 提取文件到目标路径
+        with open(local_dest_path, 'wb') as f:
+            shutil.copyfileobj(tar.extractfile(member), f, ARCHIVE_CHUNK_SIZE)
+
 @mcp.tool()
-async def copy_file_from_sandbox(container_id: str, container_src_path: str, workspace_id: str = None, local_dest_path: str = None) -> Dict[str, Any]:
+async def copy_file_from_sandbox(container_id: str, container_src_path: str, workspace_id: Optional[str] = None, local_dest_path: Optional[str] = None) -> Dict[str, Any]:
     """
     将单个文件从沙箱文件系统复制到本地文件系统。
     将文件从指定容器传输到本地系统。
@@ -576,13 +1304,10 @@ async def copy_file_from_sandbox(container_id: str, container_src_path: str, wor
     复制操作的结果
     """
     if not docker_available:
-        return {
-            "success": False,
-            "error": "Docker服务不可用"
-        }
+        return DOCKER_UNAVAILABLE
     
     try:
-        container = docker_client.containers.get(container_id)
+        container = await lookup_container(container_id)
         
         # 判断是否是持久化容器模式
         is_persistent = workspace_id is not None
@@ -597,28 +1322,7 @@ async def copy_file_from_sandbox(container_id: str, container_src_path: str, wor
         
         logger.info(f"从容器 {container_id} 复制文件 {container_src_path} 到本地路径: {local_dest_path}")
         
-        # 获取容器中的文件
-        bits, stat = container.get_archive(container_src_path)
-        
-        # 创建包含目标目录的父目录（如果需要）
-        parent_dir = os.path.dirname(local_dest_path)
-        if parent_dir and not os.path.exists(parent_dir):
-            os.makedirs(parent_dir)
-        
-        # 提取文件到本地文件系统
-        file_obj = BytesIO.BytesIO()
-        for chunk in bits:
-            file_obj.write(chunk)
-        file_obj.seek(0)
-        
-        # 解压tarball
-        with tarfile.open(fileobj=file_obj) as tar:
-            # 获取第一个文件成员（应该只有一个）
-            member = tar.getmembers()[0]
-            
-            # 提取文件到目标路径
-            with open(local_dest_path, 'wb') as f:
-                f.write(tar.extractfile(member).read())
+        await run_blocking(download_file_from_container, container, container_src_path, local_dest_path)
         
         return {
             "success": True,
@@ -646,14 +1350,13 @@ async def sandbox_stop(container_id: str, is_persistent: bool = False) -> Dict[s
     停止操作的结果
     """
     if not docker_available:
-        return {
-            "success": False,
-            "error": "Docker服务不可用"
-        }
+        return DOCKER_UNAVAILABLE
     
     try:
-        # 如果是持久化容器，不实际停止它
-        if is_persistent or container_id == persistent_container_id:
+        container = await lookup_container(container_id)
+        
+        # 如果是持久化容器（池容器可能承载多个工作区），不实际停止它；工作区通过clean_workspace清理
+        if is_persistent or container.id in pooled_containers:
             logger.info(f"容器 {container_id} 是持久化容器，不会停止")
             return {
                 "success": True,
@@ -661,13 +1364,14 @@ async def sandbox_stop(container_id: str, is_persistent: bool = False) -> Dict[s
             }
             
         # 否则，停止并移除容器
-        container = docker_client.containers.get(container_id)
-        
         logger.info(f"停止容器 {container_id}")
-        container.stop(timeout=10)
+        await run_blocking(container.stop, timeout=10)
         
         logger.info(f"移除容器 {container_id}")
-        container.remove(v=True)  # v=True 同时移除关联的卷
+        await run_blocking(container.remove, v=True)  # v=True 同时移除关联的卷
+        invalidate_container(container_id)
+        forget_projects(container.id)
+        forget_exec_locks(container.id)
         
         return {
             "success": True,
@@ -693,19 +1397,21 @@ async def clean_workspace(container_id: str, workspace_id: str) -> Dict[str, Any
     清理操作的结果
     """
     if not docker_available:
-        return {
-            "success": False,
-            "error": "Docker服务不可用"
-        }
+        return DOCKER_UNAVAILABLE
     
     try:
-        container = docker_client.containers.get(container_id)
+        container = await lookup_container(container_id)
         workspace_path = f"/app/workspaces/{workspace_id}"
         
         logger.info(f"清理容器 {container_id} 中的工作区: {workspace_path}")
         
-        # 删除工作区目录
-        container.exec_run(["rm", "-rf", workspace_path])
+        # 删除工作区目录；工作区专用的GPU容器会被一起删除
+        removed = await run_blocking(remove_workspace, container, workspace_id)
+        
+        # 执行锁只在事件循环中增删
+        container_exec_locks.pop((container.id, workspace_id), None)
+        if removed:
+            forget_exec_locks(container.id)
         
         return {
             "success": True,
@@ -731,16 +1437,13 @@ async def get_container_logs(container_id: str) -> Dict[str, Any]:
     包含日志内容的字典
     """
     if not docker_available:
-        return {
-            "success": False,
-            "error": "Docker服务不可用"
-        }
+        return DOCKER_UNAVAILABLE
     
     try:
-        container = docker_client.containers.get(container_id)
+        container = await lookup_container(container_id)
         
         logger.info(f"获取容器 {container_id} 的日志")
-        logs = container.logs().decode('utf-8')
+        logs = (await run_blocking(container.logs)).decode('utf-8')
         
         return {
             "success": True,
@@ -754,57 +1457,58 @@ async def get_container_logs(container_id: str) -> Dict[str, Any]:
         }
 
 # SSE传输设置
-def create_starlette_app(mcp_server: Server, *, debug: bool = False) -> Starlette:
-    """创建一个可以通过SSE提供给定mcp服务器的Starlette应用程序。"""
-    sse = SseServerTransport("/messages/")
-
-    async def handle_sse(request: Request) -> None:
-        async with sse.connect_sse(
-                request.scope,
-                request.receive,
-                request._send,  # noqa: SLF001
-        ) as (read_stream, write_stream):
-            await mcp_server.run(
-                read_stream,
-                write_stream,
-                mcp_server.create_initialization_options(),
-            )
+# 传输、处理函数和路由表在模块加载时创建一次，create_starlette_app只负责包装
+sse = SseServerTransport("/messages/")
 
-    return Starlette(
-        debug=debug,
-        routes=[
-            Route("/sse", endpoint=handle_sse),
-            Mount("/messages/", app=sse.handle_post_message),
-        ],
-    )
 
-# 应用启动时启动一个持久化容器
-def start_persistent_container():
-    if docker_available:
-        try:
-            logger.info("启动时初始化持久化容器...")
-            ensure_persistent_container()
-            logger.info(f"持久化容器已准备就绪: {persistent_container_id}")
-        except Exception as e:
-            logger.error(f"初始化持久化容器失败: {e}")
+async def handle_sse(request: Request) -> None:
+    """处理SSE连接，在连接上运行MCP服务器。"""
+    mcp_server = mcp._mcp_server
+    async with sse.connect_sse(
+            request.scope,
+            request.receive,
+            request._send,  # noqa: SLF001
+    ) as (read_stream, write_stream):
+        await mcp_server.run(
+            read_stream,
+            write_stream,
+            mcp_server.create_initialization_options(),
+        )
+
+
+sse_routes = [
+    Route("/sse", endpoint=handle_sse),
+    Mount("/messages/", app=sse.handle_post_message),
+]
+
+
+def create_starlette_app(*, debug: bool = False) -> Starlette:
+    """创建通过SSE提供MCP服务器的Starlette应用程序。
+
+    SSE会话保存在当前进程的传输对象中，/sse连接与对应的/messages/请求
+    必须落在同一进程，因此不要用uvicorn的多worker模式运行。
+    """
+    return Starlette(debug=debug, routes=sse_routes)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='运行Code Sandbox MCP服务器')
     parser.add_argument('--host', default='0.0.0.0', help='绑定的主机')
     parser.add_argument('--port', type=int, default=9520, help='监听的端口')
     parser.add_argument('--no-persistent', action='store_true', help='禁用持久化容器模式')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE, help='容器池中常驻容器的数量')
+    parser.add_argument('--gpu', action='store_true', default=POOL_USE_GPU, help='为容器池中的每个容器分配一块GPU')
     args = parser.parse_args()
 
-    # 获取MCP服务器实例
-    mcp_server = mcp._mcp_server
-
-    # 初始化持久化容器（如果未禁用）
+    # 初始化容器池（如果未禁用）
+    POOL_SIZE = args.pool_size
+    POOL_USE_GPU = args.gpu
     if not args.no_persistent:
-        start_persistent_container()
+        start_container_pool()
 
     # 创建Starlette应用
-    starlette_app = create_starlette_app(mcp_server, debug=True)
+    starlette_app = create_starlette_app(debug=True)
 
     # 启动服务器
     print(f"启动Code Sandbox MCP服务器，监听 {args.host}:{args.port}")
-    uvicorn.run(starlette_app, host=args.host, port=args.port)
\ No newline at end of file
+    # loop/http为auto时，安装了uvloop和httptools就会使用它们，否则回退到asyncio和h11（如PyPy）
+    uvicorn.run(starlette_app, host=args.host, port=args.port, loop="auto", http="auto")
\ No newline at end of file